@@ -1,8 +1,13 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request
 from aws_xray_sdk.core import xray_recorder
 from aws_xray_sdk.ext.flask.middleware import XRayMiddleware
 import logging
-from aws_xray_sdk.core import patch_all
+from logging.handlers import QueueHandler, QueueListener
+from aws_xray_sdk.core import patch
+import atexit
+import copy
+import queue
+from contextlib import contextmanager
 import json
 import uuid
 import time
@@ -10,6 +15,11 @@ import random
 import os
 import boto3
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # ========== CONFIG SECTION ==========
 # Values can be overridden by environment variables
 APP_NAME = os.environ.get('APP_NAME', "FlaskXRayTemplate")
@@ -18,39 +28,88 @@ CW_LOG_GROUP = os.environ.get('CW_LOG_GROUP', "/flask/xray-demo")
 ENABLE_X_RAY = os.environ.get('ENABLE_X_RAY', 'true').lower() == 'true'
 ENABLE_CW_LOGS = os.environ.get('ENABLE_CW_LOGS', 'true').lower() == 'true'
 STAGE = os.environ.get('STAGE', 'dev')
+# Lambda freezes the process between invocations, so records left in a
+# background queue would be delayed or lost; log synchronously there
+USE_LOG_QUEUE = 'AWS_LAMBDA_FUNCTION_NAME' not in os.environ
+# Comma-separated list of libraries to instrument with X-Ray (none by default,
+# the service makes no outbound calls that need tracing)
+XRAY_PATCH_MODULES = tuple(m.strip() for m in os.environ.get('XRAY_PATCH_MODULES', '').split(',') if m.strip())
 # ===================================
 
 # Configure logging
 logger = logging.getLogger(APP_NAME)
 logger.setLevel(LOG_LEVEL)
 
+# Prefix marking custom metadata fields passed via `extra`
+METADATA_PREFIX = 'metadata_'
+METADATA_PREFIX_LEN = len(METADATA_PREFIX)
+
 # Create a custom formatter that includes timestamp and request metadata
 class JsonFormatter(logging.Formatter):
+    # Fields serialized into the constant prefix; metadata may not override them
+    STATIC_KEYS = frozenset(("app_name", "stage"))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Serialize the constant fields once; format() splices in the per-record ones
+        static_fields = {"app_name": APP_NAME, "stage": STAGE}
+        if orjson is not None:
+            self._prefix = orjson.dumps(static_fields)[:-1] + b','
+        else:
+            self._prefix = json.dumps(static_fields)[:-1] + ', '
+
     def format(self, record):
         log_record = {
             "timestamp": self.formatTime(record),
             "level": record.levelname,
             "message": record.getMessage(),
-            "app_name": APP_NAME,
-            "stage": STAGE,
         }
         
         # Add request_id if available
         if hasattr(record, "request_id"):
             log_record["request_id"] = record.request_id
         
-        # Add any custom metadata fields
-        for attr in dir(record):
-            if attr.startswith('metadata_') and not callable(getattr(record, attr)):
-                key = attr.replace('metadata_', '')
-                log_record[key] = getattr(record, attr)
+        # Add any custom metadata fields (skipping keys already in the prefix,
+        # which would otherwise be emitted twice)
+        for attr, value in record.__dict__.items():
+            if attr.startswith(METADATA_PREFIX):
+                key = attr[METADATA_PREFIX_LEN:]
+                if key not in self.STATIC_KEYS:
+                    log_record[key] = value
                 
-        return json.dumps(log_record)
+        if orjson is not None:
+            return (self._prefix + orjson.dumps(log_record)[1:]).decode('utf-8')
+        return self._prefix + json.dumps(log_record)[1:]
+
+# Queue handler that keeps exc_info on the record instead of folding the
+# traceback into the message, so JsonFormatter output is unchanged
+class JsonQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+# Route records through a queue so handler I/O happens off the request thread
+if USE_LOG_QUEUE:
+    log_queue = queue.Queue(-1)
+    logger.addHandler(JsonQueueHandler(log_queue))
+
+log_handlers = []
+
+# Attach a handler directly, or hand it to the queue listener when logging off-thread
+def add_log_handler(handler):
+    log_handlers.append(handler)
+    if not USE_LOG_QUEUE:
+        logger.addHandler(handler)
+
+# Single formatter shared by all handlers
+json_formatter = JsonFormatter()
 
 # Add console handler for local development
 console_handler = logging.StreamHandler()
-console_handler.setFormatter(JsonFormatter())
-logger.addHandler(console_handler)
+console_handler.setFormatter(json_formatter)
+add_log_handler(console_handler)
 
 # Add CloudWatch Logs handler if enabled
 if ENABLE_CW_LOGS:
@@ -65,15 +124,21 @@ if ENABLE_CW_LOGS:
             stream_name=log_stream_name,
             boto3_client=boto3.client('logs')
         )
-        cw_handler.setFormatter(JsonFormatter())
-        logger.addHandler(cw_handler)
-        logger.info(f"CloudWatch Logs enabled with log group {CW_LOG_GROUP}, stream {log_stream_name}")
+        cw_handler.setFormatter(json_formatter)
+        add_log_handler(cw_handler)
+        logger.info("CloudWatch Logs enabled with log group %s, stream %s", CW_LOG_GROUP, log_stream_name)
     except Exception as e:
-        logger.warning(f"Failed to initialize CloudWatch Logs: {str(e)}")
+        logger.warning("Failed to initialize CloudWatch Logs: %s", e)
 
 # Initialize Flask app
 app = Flask(__name__)
 
+# Start background listener that owns the console and CloudWatch handlers
+if USE_LOG_QUEUE:
+    log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
 # Configure X-Ray if enabled
 if ENABLE_X_RAY:
     try:
@@ -82,72 +147,130 @@ if ENABLE_X_RAY:
             context_missing='LOG_ERROR'
         )
         XRayMiddleware(app, xray_recorder)
-        patch_all()  # Patch all supported libraries for X-Ray
+        if XRAY_PATCH_MODULES:
+            # Patch only the listed libraries, skipping any that are not installed
+            patch(XRAY_PATCH_MODULES, raise_errors=False)
         logger.info("AWS X-Ray integration enabled")
     except Exception as e:
-        logger.warning(f"Failed to initialize X-Ray: {str(e)}")
+        logger.warning("Failed to initialize X-Ray: %s", e)
 
 # ========== MIDDLEWARE SECTION ==========
 
 # Request middleware to add request_id and start time
 @app.before_request
 def before_request():
+    # Health checks skip request tracking and logging entirely
+    if request.endpoint == 'health':
+        return
+    
     # Generate or retrieve request ID
-    if request.headers.get('X-Request-ID'):
-        request.request_id = request.headers.get('X-Request-ID')
-    else:
-        request.request_id = str(uuid.uuid4())
+    request_id = request.headers.get('X-Request-ID') or os.urandom(16).hex()
+    request.request_id = request_id
     
     # Record start time for duration calculation
-    request.start_time = time.time()
+    request.start_time_ns = time.monotonic_ns()
     
-    # Log incoming request
-    logger.info(f"Received request: {request.method} {request.path}",
-                extra={
-                    'request_id': request.request_id,
-                    'metadata_method': request.method,
-                    'metadata_path': request.path,
-                    'metadata_ip': request.remote_addr
-                })
+    # Log incoming request (skip building the payload when INFO is filtered)
+    if logger.isEnabledFor(logging.INFO):
+        env = request.environ
+        method = env['REQUEST_METHOD']
+        path = request.path
+        logger.info("Received request: %s %s", method, path,
+                    extra={
+                        'request_id': request_id,
+                        'metadata_method': method,
+                        'metadata_path': path,
+                        'metadata_ip': env.get('REMOTE_ADDR', '')
+                    })
 
 # Logging middleware
 @app.after_request
 def after_request(response):
+    if request.endpoint == 'health':
+        return response
+    
+    # before_request sets both attributes; they are only missing when an earlier
+    # before_request hook (e.g. XRayMiddleware's) raised, which handle_exception
+    # already logged. Bail out so the remaining after_request hooks still run.
+    try:
+        start_time_ns = request.start_time_ns
+        request_id = request.request_id
+    except AttributeError:
+        return response
+    
     # Calculate request duration
-    duration_ms = 0
-    if hasattr(request, 'start_time'):
-        duration_ms = int((time.time() - request.start_time) * 1000)
+    duration_ms = (time.monotonic_ns() - start_time_ns) // 1_000_000
     
     # Add response headers
-    response.headers['X-Request-ID'] = getattr(request, 'request_id', 'unknown')
+    response.headers['X-Request-ID'] = request_id
     
-    # Log request completion
-    logger.info(
-        f"Request completed: {request.method} {request.path}",
-        extra={
-            'request_id': getattr(request, 'request_id', 'unknown'),
-            'metadata_method': request.method,
-            'metadata_path': request.path,
-            'metadata_status_code': response.status_code,
-            'metadata_duration_ms': duration_ms,
-            'metadata_ip': request.remote_addr
-        }
-    )
+    # Log request completion (skip building the payload when INFO is filtered)
+    if logger.isEnabledFor(logging.INFO):
+        # Read method and client IP straight from the WSGI environ; the path
+        # goes through request.path so it is decoded from the latin-1 PATH_INFO
+        env = request.environ
+        method = env['REQUEST_METHOD']
+        path = request.path
+        ip = env.get('REMOTE_ADDR', '')
+        logger.info(
+            "Request completed: %s %s", method, path,
+            extra={
+                'request_id': request_id,
+                'metadata_method': method,
+                'metadata_path': path,
+                'metadata_status_code': response.status_code,
+                'metadata_duration_ms': duration_ms,
+                'metadata_ip': ip
+            }
+        )
     return response
 
 # Error handling
 @app.errorhandler(Exception)
 def handle_exception(e):
-    logger.exception(f"Unhandled exception: {str(e)}",
+    logger.exception("Unhandled exception: %s", e,
                      extra={'request_id': getattr(request, 'request_id', 'unknown')})
     
-    return jsonify({
+    return ojsonify({
         "error": str(e),
         "request_id": getattr(request, "request_id", "unknown")
-    }), 500
+    }, 500)
 
 # ========== UTILITY FUNCTIONS ==========
 
+# Serialize to JSON bytes, using orjson when available
+def _json_bytes(obj):
+    """Serialize obj to UTF-8 encoded JSON"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+# Build a JSON response, serializing with orjson when available
+def ojsonify(obj, status=200):
+    """
+    Drop-in replacement for jsonify that uses orjson for serialization
+    
+    Args:
+        obj (dict): Data to serialize
+        status (int): HTTP status code of the response
+        
+    Returns:
+        Response: JSON response
+    """
+    return Response(_json_bytes(obj), status=status, mimetype='application/json')
+
+# No-op stand-in for xray_recorder.in_subsegment when X-Ray is disabled
+@contextmanager
+def _noop_subsegment(*args, **kwargs):
+    yield None
+
+# Select the subsegment context manager once instead of branching per call
+_subsegment = xray_recorder.in_subsegment if ENABLE_X_RAY else _noop_subsegment
+
+# Module RNG bound once to avoid attribute lookups in the simulators (the
+# shared instance is reseeded after fork, unlike a private random.Random)
+_random = random.random
+
 # Simulate database operation with X-Ray subsegment
 def simulate_db_operation(operation_name, failure_rate=0.05):
     """
@@ -160,29 +283,21 @@ def simulate_db_operation(operation_name, failure_rate=0.05):
     Returns:
         dict: Result of the operation
     """
-    if not ENABLE_X_RAY:
-        # If X-Ray is disabled, skip subsegment creation
-        time.sleep(random.uniform(0.05, 0.2))
-        if random.random() < failure_rate:
-            logger.error(f"Database operation '{operation_name}' failed")
-            return {"status": "error", "operation": operation_name}
-        logger.info(f"Database operation '{operation_name}' completed")
-        return {"status": "success", "operation": operation_name}
-    
-    with xray_recorder.in_subsegment(f'database_{operation_name}'):
+    with _subsegment(f'database_{operation_name}') as subsegment:
         # Simulate DB latency
-        time.sleep(random.uniform(0.05, 0.2))
+        time.sleep(0.05 + _random() * 0.15)
         
         # Simulate failures based on failure_rate
-        if random.random() < failure_rate:
-            logger.error(f"Database operation '{operation_name}' failed")
-            xray_recorder.current_subsegment().add_exception(
-                Exception(f"DB operation {operation_name} failure"),
-                stack=None
-            )
+        if _random() < failure_rate:
+            logger.error("Database operation '%s' failed", operation_name)
+            if subsegment is not None:
+                subsegment.add_exception(
+                    Exception(f"DB operation {operation_name} failure"),
+                    stack=None
+                )
             return {"status": "error", "operation": operation_name}
             
-        logger.info(f"Database operation '{operation_name}' completed")
+        logger.info("Database operation '%s' completed", operation_name)
         return {"status": "success", "operation": operation_name}
 
 # Simulate external API call with X-Ray subsegment
@@ -197,51 +312,62 @@ def simulate_external_api_call(api_name, failure_rate=0.1):
     Returns:
         dict: Result of the API call
     """
-    if not ENABLE_X_RAY:
-        # If X-Ray is disabled, skip subsegment creation
-        time.sleep(random.uniform(0.1, 0.3))
-        if random.random() < failure_rate:
-            logger.error(f"API call to '{api_name}' failed")
-            return {"status": "error", "api": api_name}
-        logger.info(f"API call to '{api_name}' completed")
-        return {"status": "success", "api": api_name}
-    
-    with xray_recorder.in_subsegment(f'external_api_{api_name}'):
+    with _subsegment(f'external_api_{api_name}') as subsegment:
         # Simulate API latency
-        time.sleep(random.uniform(0.1, 0.3))
+        time.sleep(0.1 + _random() * 0.2)
         
         # Random failure simulation based on failure_rate
-        if random.random() < failure_rate:
-            logger.error(f"API call to '{api_name}' failed")
-            xray_recorder.current_subsegment().add_exception(
-                Exception(f"API {api_name} failure"),
-                stack=None
-            )
+        if _random() < failure_rate:
+            logger.error("API call to '%s' failed", api_name)
+            if subsegment is not None:
+                subsegment.add_exception(
+                    Exception(f"API {api_name} failure"),
+                    stack=None
+                )
             return {"status": "error", "api": api_name}
             
-        logger.info(f"API call to '{api_name}' completed")
+        logger.info("API call to '%s' completed", api_name)
         return {"status": "success", "api": api_name}
 
-# Add X-Ray annotation if enabled
-def add_annotation(key, value):
-    """Add X-Ray annotation safely"""
-    if ENABLE_X_RAY and xray_recorder.current_segment():
-        try:
-            xray_recorder.current_segment().put_annotation(key, value)
-        except Exception as e:
-            logger.warning(f"Failed to add X-Ray annotation: {str(e)}")
-
-# Add X-Ray metadata if enabled
-def add_metadata(namespace, key, value):
-    """Add X-Ray metadata safely"""
-    if ENABLE_X_RAY and xray_recorder.current_segment():
-        try:
-            xray_recorder.current_segment().put_metadata(key, value, namespace)
-        except Exception as e:
-            logger.warning(f"Failed to add X-Ray metadata: {str(e)}")
+# X-Ray helpers are bound once at import; the disabled variants are no-ops
+if ENABLE_X_RAY:
+    # Add X-Ray annotation to the current segment
+    def add_annotation(key, value):
+        """Add X-Ray annotation safely"""
+        segment = xray_recorder.current_segment()
+        if segment:
+            try:
+                segment.put_annotation(key, value)
+            except Exception as e:
+                logger.warning("Failed to add X-Ray annotation: %s", e)
+
+    # Add X-Ray metadata to the current segment
+    def add_metadata(namespace, key, value):
+        """Add X-Ray metadata safely"""
+        segment = xray_recorder.current_segment()
+        if segment:
+            try:
+                segment.put_metadata(key, value, namespace)
+            except Exception as e:
+                logger.warning("Failed to add X-Ray metadata: %s", e)
+else:
+    def add_annotation(key, value):
+        """No-op: X-Ray is disabled"""
+
+    def add_metadata(namespace, key, value):
+        """No-op: X-Ray is disabled"""
 
 # ========== ROUTE HANDLERS ==========
 
+# Constant response bodies are serialized once at import
+_HEALTH_BODY = _json_bytes({"status": "healthy"})
+_INDEX_PREFIX = _json_bytes({
+    "service": APP_NAME,
+    "status": "healthy",
+    "version": "1.0.0",
+    "stage": STAGE
+})[:-1] + b',"request_id":'
+
 # Root endpoint
 @app.route('/')
 def index():
@@ -249,15 +375,11 @@ def index():
         logger.info("Processing root endpoint request", 
                     extra={'request_id': getattr(request, 'request_id', 'unknown')})
         
-        return jsonify({
-            "service": APP_NAME,
-            "status": "healthy",
-            "version": "1.0.0",
-            "stage": STAGE,
-            "request_id": getattr(request, "request_id", "unknown")
-        })
+        # Splice the request ID into the pre-serialized constant fields
+        body = _INDEX_PREFIX + _json_bytes(getattr(request, "request_id", "unknown")) + b'}'
+        return Response(body, mimetype='application/json')
     except Exception as e:
-        logger.exception(f"Error in root endpoint: {str(e)}",
+        logger.exception("Error in root endpoint: %s", e,
                          extra={'request_id': getattr(request, 'request_id', 'unknown')})
         raise
 
@@ -265,7 +387,7 @@ def index():
 @app.route('/resources/<resource_id>')
 def get_resource(resource_id):
     try:
-        logger.info(f"Fetching resource data", 
+        logger.info("Fetching resource data", 
                     extra={
                         'request_id': getattr(request, 'request_id', 'unknown'),
                         'metadata_resource_id': resource_id
@@ -277,14 +399,14 @@ def get_resource(resource_id):
         # Simulate database query
         db_result = simulate_db_operation("get_resource")
         
-        return jsonify({
+        return ojsonify({
             "resource_id": resource_id,
             "name": f"Resource {resource_id}",
             "status": db_result["status"],
             "request_id": getattr(request, "request_id", "unknown")
         })
     except Exception as e:
-        logger.exception(f"Error fetching resource: {str(e)}",
+        logger.exception("Error fetching resource: %s", e,
                          extra={'request_id': getattr(request, 'request_id', 'unknown')})
         raise
 
@@ -292,7 +414,7 @@ def get_resource(resource_id):
 @app.route('/resources/<resource_id>/items')
 def get_resource_items(resource_id):
     try:
-        logger.info(f"Fetching items for resource", 
+        logger.info("Fetching items for resource", 
                     extra={
                         'request_id': getattr(request, 'request_id', 'unknown'),
                         'metadata_resource_id': resource_id
@@ -312,7 +434,7 @@ def get_resource_items(resource_id):
             {"item_id": f"{resource_id}-2", "status": "pending"}
         ]
         
-        return jsonify({
+        return ojsonify({
             "resource_id": resource_id,
             "items": items,
             "db_status": db_result["status"],
@@ -320,7 +442,7 @@ def get_resource_items(resource_id):
             "request_id": getattr(request, "request_id", "unknown")
         })
     except Exception as e:
-        logger.exception(f"Error fetching resource items: {str(e)}",
+        logger.exception("Error fetching resource items: %s", e,
                          extra={'request_id': getattr(request, 'request_id', 'unknown')})
         raise
 
@@ -334,24 +456,25 @@ def error_endpoint():
         # Simulate error
         raise Exception("This is a test error")
     except Exception as e:
-        logger.exception(f"Error occurred: {str(e)}", 
+        logger.exception("Error occurred: %s", e, 
                         extra={'request_id': getattr(request, 'request_id', 'unknown')})
         
         # Add X-Ray annotation
         add_annotation('error', 'true')
         
-        return jsonify({
+        return ojsonify({
             "error": str(e),
             "request_id": getattr(request, "request_id", "unknown")
-        }), 500
+        }, 500)
 
 # Health check endpoint
 @app.route('/health')
 def health():
-    return jsonify({"status": "healthy"})
+    return Response(_HEALTH_BODY, mimetype='application/json')
 
 # ========== RUN APPLICATION ==========
 
+# Local development only; serve with gunicorn (see gunicorn.conf.py) elsewhere
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(debug=os.environ.get('DEBUG', 'False').lower() == 'true', 
@@ -0,0 +1,12 @@
+# Gunicorn configuration for running the app outside of Lambda/Zappa
+# Usage: pip install gunicorn gevent && gunicorn app:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# gevent workers monkey-patch blocking calls (time.sleep, sockets) so that
+# I/O-bound requests overlap instead of serializing per worker
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))